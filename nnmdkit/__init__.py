@@ -1,3 +1,8 @@
 from nnmdkit.core.System import System
 from nnmdkit.core.Lammps import Lammps
-from nnmdkit.core.Job import Job
\ No newline at end of file
+from nnmdkit.core.Job import Job
+from nnmdkit.core.Analysis import Analysis
+from nnmdkit.core.Database import Database
+from nnmdkit.core.WorkQueue import WorkQueue
+from nnmdkit.core.Screening import Screening
+from nnmdkit.core.Library import Library
\ No newline at end of file
@@ -0,0 +1,320 @@
+import numpy as np
+from multiprocessing import Pool, RawArray
+from nnmdkit.util import Util
+
+
+class Analysis:
+    '''nnmdkit.core.Analysis.Analysis
+
+    Template object to contain trajectory analysis settings
+
+    Attributes:
+        traj_fname: str
+            File name of the LAMMPS custom dump trajectory (e.g. production.lammpstrj)
+
+        rdf_rmax: float
+            Cutoff distance of the radial distribution function; default=10.0 Angstrom
+
+        rdf_nbins: int
+            Number of bins of the radial distribution function; default=100
+
+        masses: dict
+            Mass of each atom type used to weight the radius of gyration; default=None (unweighted)
+
+        nprocs: int
+            Number of worker processes used to analyze frames; default=1
+
+        chunk: int
+            Number of frames held in shared memory at once; default=64
+
+    rdf_rmax may not exceed half of the shortest box length, beyond which the
+    minimum image convention no longer gives all pairs. Only orthogonal boxes
+    are supported.
+    '''
+    def __init__(self,
+                 traj_fname,
+                 rdf_rmax=10.0,
+                 rdf_nbins=100,
+                 masses=None,
+                 nprocs=1,
+                 chunk=64):
+        self.traj_fname = traj_fname
+        self.rdf_rmax = rdf_rmax
+        self.rdf_nbins = rdf_nbins
+        self.masses = masses
+        self.nprocs = nprocs
+        self.chunk = chunk
+
+    def iter_frames(self, every=1):
+        '''Stream every every-th frame of the trajectory one at a time
+
+        Each frame is a dict with the timestep, the box length, the per-atom
+        columns sorted by atom id and the unwrapped coordinates. The atom
+        lines of skipped frames are read past without being parsed.
+        '''
+        with open(self.traj_fname, 'rt') as lines:
+            n = 0
+            while True:
+                line = lines.readline()
+                if not line:
+                    return
+                if not line.startswith('ITEM: TIMESTEP'):
+                    continue
+                step = int(lines.readline())
+                lines.readline()
+                natoms = int(lines.readline())
+                header = lines.readline()
+                # Tilted boxes carry xy xz yz factors that are not handled
+                if 'xy' in header.split():
+                    raise ValueError(
+                        'triclinic boxes are not supported: {}'.format(
+                            header.strip()))
+                if n % every:
+                    for _ in range(natoms + 4):
+                        lines.readline()
+                    n += 1
+                    continue
+                n += 1
+                bounds = np.array(
+                    [[float(x) for x in lines.readline().split()[:2]]
+                     for _ in range(3)])
+                columns = lines.readline().split()[2:]
+                table = np.array(
+                    [lines.readline().split() for _ in range(natoms)],
+                    dtype=float)
+                yield _parse_frame(step, bounds, columns, table)
+
+    def run(self, output_dir='.', every=1):
+        '''Compute Rg, end-to-end distance and RDF over the whole trajectory
+
+        Frames are read in chunks, copied into a shared memory block and
+        split across a pool of worker processes. Per-frame chain averages are
+        written to rg_vs_step and end_to_end_vs_step, the frame-averaged RDF
+        to rdf.
+        '''
+        Util.build_dir(output_dir)
+
+        steps = []
+        rg = []
+        ree = []
+        rdf_sum = np.zeros(self.rdf_nbins)
+        nframes = 0
+        pool = None
+        chunk = []
+        try:
+            for frame in self.iter_frames(every):
+                if self.rdf_rmax > frame['box'].min() / 2:
+                    raise ValueError(
+                        'rdf_rmax {} exceeds half of the box {} at step {}'.
+                        format(self.rdf_rmax, frame['box'], frame['step']))
+                chunk.append(frame)
+                if len(chunk) == self.chunk:
+                    if pool is None:
+                        pool = self._start_pool(frame)
+                    nframes += self._run_chunk(pool, chunk, steps, rg, ree,
+                                               rdf_sum)
+                    chunk = []
+            if chunk:
+                if pool is None:
+                    pool = self._start_pool(chunk[0])
+                nframes += self._run_chunk(pool, chunk, steps, rg, ree,
+                                           rdf_sum)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        r = (np.arange(self.rdf_nbins) + 0.5) * self.rdf_rmax / self.rdf_nbins
+        g = rdf_sum / max(nframes, 1)
+
+        with open(output_dir + '/rg_vs_step', 'w') as f:
+            f.write('# step Rg_mean Rg_std\n')
+            for s, i in zip(steps, rg):
+                f.write('{} {:.6f} {:.6f}\n'.format(s, *i))
+        with open(output_dir + '/end_to_end_vs_step', 'w') as f:
+            f.write('# step Ree_mean Ree_std\n')
+            for s, i in zip(steps, ree):
+                f.write('{} {:.6f} {:.6f}\n'.format(s, *i))
+        with open(output_dir + '/rdf', 'w') as f:
+            f.write('# r g(r)\n')
+            for i, j in zip(r, g):
+                f.write('{:.6f} {:.6f}\n'.format(i, j))
+
+        return {
+            'step': np.array(steps),
+            'rg': np.array(rg),
+            'end_to_end': np.array(ree),
+            'r': r,
+            'rdf': g
+        }
+
+    def _start_pool(self, frame):
+        # Topology (mol ids and per-atom masses) is identical in every frame and
+        # is handed to each worker once through the pool initializer, together
+        # with the shared buffer every chunk of coordinates is copied into
+        weights = np.ones(len(frame['type']))
+        if self.masses is not None:
+            weights = np.array([self.masses[int(t)] for t in frame['type']],
+                               dtype=float)
+        self._shape = (self.chunk, len(frame['coords']), 3)
+        self._buffer = RawArray('d', int(np.prod(self._shape)))
+        return Pool(self.nprocs,
+                    initializer=_init_worker,
+                    initargs=(self._buffer, self._shape, frame.get('mol'),
+                              weights, self.rdf_rmax, self.rdf_nbins))
+
+    def _run_chunk(self, pool, chunk, steps, rg, ree, rdf_sum):
+        coords = np.frombuffer(self._buffer).reshape(self._shape)
+        for n, frame in enumerate(chunk):
+            coords[n] = frame['coords']
+        tasks = [(n, frame['box']) for n, frame in enumerate(chunk)]
+        for frame, result in zip(chunk, pool.map(_analyze_frame, tasks)):
+            steps.append(frame['step'])
+            rg.append(result[0])
+            ree.append(result[1])
+            rdf_sum += result[2]
+        return len(chunk)
+
+
+def read_temp_vs_density(fname='temp_vs_density'):
+    '''Read the fix ave/time output of a Tg measurement
+
+    Works for both the stepwise and the ramp protocol; returns the
+    temperature and density columns of every averaged row.
+    '''
+    data = np.loadtxt(fname, comments='#', ndmin=2)
+    return data[:, 1], data[:, 2]
+
+
+def fit_Tg(temp, density):
+    '''Estimate Tg by a bilinear fit of density against temperature
+
+    Every split point leaving at least three points on each side is tried;
+    the split with the smallest total squared residual is kept and Tg is the
+    intersection of its two lines.
+    '''
+    order = np.argsort(temp)
+    temp = np.asarray(temp, dtype=float)[order]
+    density = np.asarray(density, dtype=float)[order]
+    if len(temp) < 6:
+        raise ValueError('at least 6 points are required to fit Tg')
+
+    best = None
+    for n in range(3, len(temp) - 2):
+        low = np.polyfit(temp[:n], density[:n], 1, full=True)
+        high = np.polyfit(temp[n:], density[n:], 1, full=True)
+        sse = sum(x[1][0] if len(x[1]) else 0.0 for x in [low, high])
+        if best is None or sse < best[0]:
+            best = (sse, low[0], high[0])
+
+    _, low, high = best
+    return (high[1] - low[1]) / (low[0] - high[0])
+
+
+def _parse_frame(step, bounds, columns, table):
+    table = table[np.argsort(table[:, columns.index('id')])]
+    box = bounds[:, 1] - bounds[:, 0]
+    frame = {'step': step, 'box': box}
+    for key in ['id', 'mol', 'type']:
+        if key in columns:
+            frame[key] = table[:, columns.index(key)].astype(int)
+
+    # Accept scaled (xs), wrapped (x) or already unwrapped (xu) coordinates
+    if 'xs' in columns:
+        coords = table[:, [columns.index(x) for x in ['xs', 'ys', 'zs']]]
+        coords = coords * box + bounds[:, 0]
+    elif 'xu' in columns:
+        coords = table[:, [columns.index(x) for x in ['xu', 'yu', 'zu']]]
+    else:
+        coords = table[:, [columns.index(x) for x in ['x', 'y', 'z']]]
+
+    # Unwrap with the dumped image flags
+    if 'ix' in columns and 'xu' not in columns:
+        images = table[:, [columns.index(x) for x in ['ix', 'iy', 'iz']]]
+        coords = coords + images * box
+    frame['coords'] = coords
+    return frame
+
+
+_worker = {}
+
+
+def _init_worker(buffer, shape, mol, weights, rmax, nbins):
+    _worker['coords'] = np.frombuffer(buffer).reshape(shape)
+    _worker['rmax'] = rmax
+    _worker['nbins'] = nbins
+    _worker['weights'] = weights
+    _worker['mol'] = None
+    if mol is not None:
+        # Group atoms by chain once; atoms are sorted by id, so the first and
+        # last atom of each chain are taken as its ends
+        order = np.argsort(mol, kind='stable')
+        _, start, count = np.unique(mol[order],
+                                    return_index=True,
+                                    return_counts=True)
+        _worker['mol'] = (order, start, count)
+
+
+def _analyze_frame(task):
+    n, box = task
+    coords = np.array(_worker['coords'][n])
+
+    rg = (np.nan, np.nan)
+    ree = (np.nan, np.nan)
+    if _worker['mol'] is not None:
+        rg = _radius_of_gyration(coords, _worker['weights'], *_worker['mol'])
+        ree = _end_to_end(coords, *_worker['mol'])
+    g = _rdf(coords, box, _worker['rmax'], _worker['nbins'])
+    return rg, ree, g
+
+
+def _radius_of_gyration(coords, weights, order, start, count):
+    x = coords[order]
+    w = weights[order]
+    wsum = np.add.reduceat(w, start)
+    com = np.add.reduceat(x * w[:, None], start) / wsum[:, None]
+    dr2 = np.sum((x - np.repeat(com, count, axis=0))**2, axis=1)
+    rg = np.sqrt(np.add.reduceat(w * dr2, start) / wsum)
+    return rg.mean(), rg.std()
+
+
+def _end_to_end(coords, order, start, count):
+    x = coords[order]
+    ree = np.linalg.norm(x[start + count - 1] - x[start], axis=1)
+    return ree.mean(), ree.std()
+
+
+def _rdf(coords, box, rmax, nbins):
+    natoms = len(coords)
+    x = coords - np.floor(coords / box) * box
+    hist = np.zeros(nbins)
+
+    # Cell list with cells no smaller than rmax; since rmax <= box / 2 there
+    # are at least two cells in every direction, and with two the -1 and +1
+    # neighbours are the same cell, so neighbours are deduplicated
+    ncell = np.floor(box / rmax).astype(int)
+    cell = np.floor(x / box * ncell).astype(int) % ncell
+    cid = np.ravel_multi_index(cell.T, ncell)
+    order = np.argsort(cid, kind='stable')
+    bounds = np.searchsorted(cid[order], np.arange(np.prod(ncell) + 1))
+    offsets = np.array(np.meshgrid([-1, 0, 1], [-1, 0, 1],
+                                   [-1, 0, 1])).reshape(3, -1).T
+    for c in range(np.prod(ncell)):
+        own = order[bounds[c]:bounds[c + 1]]
+        if len(own) == 0:
+            continue
+        neighbors = np.unique(
+            np.ravel_multi_index(
+                ((np.array(np.unravel_index(c, ncell)) + offsets) % ncell).T,
+                ncell))
+        other = np.concatenate(
+            [order[bounds[j]:bounds[j + 1]] for j in neighbors])
+        dr = x[other][None, :, :] - x[own][:, None, :]
+        dr -= np.round(dr / box) * box
+        r = np.sqrt(np.sum(dr**2, axis=2))
+        hist += np.histogram(r[r > 0], bins=nbins, range=(0, rmax))[0]
+
+    edges = np.linspace(0, rmax, nbins + 1)
+    shell = 4.0 / 3.0 * np.pi * (edges[1:]**3 - edges[:-1]**3)
+    rho = natoms / np.prod(box)
+    return hist / (natoms * rho * shell)
@@ -0,0 +1,194 @@
+import os
+import re
+import time
+import sqlite3
+import hashlib
+from contextlib import closing
+from nnmdkit.core.Analysis import read_temp_vs_density, fit_Tg
+
+# Files whose changes require a run directory to be reprocessed
+TRACKED_FILES = [
+    'lmp.in', 'job.pbs', 'log.lammps', 'temp_vs_density',
+    'equilibrated.restart', 'production.restart'
+]
+
+# Files small enough to be fingerprinted by content when content_hash is set
+HASHED_FILES = ['lmp.in', 'job.pbs', 'log.lammps', 'temp_vs_density']
+
+
+class Database:
+    '''nnmdkit.core.Database.Database
+
+    Template object to contain the results database of a campaign
+
+    Attributes:
+        db_fname: str
+            File name of the SQLite database; created if it does not exist
+
+        content_hash: bool
+            Fingerprint text outputs by content instead of mtime and size; default=False
+    '''
+    def __init__(self, db_fname, content_hash=False):
+        self.db_fname = db_fname
+        self.content_hash = content_hash
+        with closing(sqlite3.connect(self.db_fname)) as conn, conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS results ('
+                         'path TEXT PRIMARY KEY, '
+                         'name TEXT, '
+                         'fingerprint TEXT, '
+                         'state TEXT, '
+                         'Tg REAL, '
+                         'final_density REAL, '
+                         'final_temp REAL, '
+                         'density_at_final_temp REAL, '
+                         'nsteps INTEGER, '
+                         'loop_time REAL, '
+                         'wall_time REAL, '
+                         'updated REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_name ON results (name)')
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS idx_state ON results (state)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_Tg ON results (Tg)')
+
+    def collect(self, campaign_dir):
+        '''Ingest every new or changed run directory below campaign_dir
+
+        A run directory is any directory containing lmp.in. Directories whose
+        fingerprint matches the stored one are skipped, and rows of
+        directories that no longer exist are removed. Returns the number of
+        directories (re)processed.
+        '''
+        campaign_dir = os.path.abspath(campaign_dir)
+        run_dirs = [
+            root for root, _, files in os.walk(campaign_dir)
+            if 'lmp.in' in files
+        ]
+
+        with closing(sqlite3.connect(self.db_fname)) as conn, conn:
+            stored = {
+                path: fingerprint
+                for path, fingerprint in conn.execute(
+                    'SELECT path, fingerprint FROM results')
+                if path == campaign_dir
+                or path.startswith(campaign_dir + os.sep)
+            }
+
+            nupdated = 0
+            for run_dir in run_dirs:
+                fingerprint = self._fingerprint(run_dir)
+                if stored.pop(run_dir, None) == fingerprint:
+                    continue
+                row = parse_run_dir(run_dir)
+                conn.execute(
+                    'INSERT OR REPLACE INTO results VALUES '
+                    '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (run_dir, os.path.relpath(run_dir, campaign_dir),
+                     fingerprint, row['state'], row['Tg'],
+                     row['final_density'], row['final_temp'],
+                     row['density_at_final_temp'], row['nsteps'],
+                     row['loop_time'], row['wall_time'], time.time()))
+                nupdated += 1
+
+            conn.executemany('DELETE FROM results WHERE path = ?',
+                             [(path, ) for path in stored])
+        return nupdated
+
+    def query(self, sql, params=()):
+        with closing(sqlite3.connect(self.db_fname)) as conn:
+            return conn.execute(sql, params).fetchall()
+
+    def _fingerprint(self, run_dir):
+        h = hashlib.sha1()
+        for fname in TRACKED_FILES:
+            path = os.path.join(run_dir, fname)
+            if not os.path.isfile(path):
+                continue
+            h.update(fname.encode())
+            if self.content_hash and fname in HASHED_FILES:
+                with open(path, 'rb') as f:
+                    for block in iter(lambda: f.read(1 << 20), b''):
+                        h.update(block)
+            else:
+                stat = os.stat(path)
+                h.update('{} {}'.format(stat.st_size,
+                                        stat.st_mtime_ns).encode())
+        return h.hexdigest()
+
+
+def parse_run_dir(run_dir):
+    '''Derive the results of a single run directory
+
+    state is one of prepared, running, equilibrated, completed or failed;
+    runs started from a Library restart count as equilibrated once they have
+    written log.lammps.
+    Timings are read from log.lammps: nsteps and loop_time are summed over
+    all run commands, wall_time is the total wall time of a finished run.
+    final_density is the density at the end of equilibration (Tfinal,
+    Pfinal) printed to log.lammps; final_temp and density_at_final_temp are
+    the last (coldest) row of temp_vs_density.
+    '''
+    row = {
+        'state': 'prepared',
+        'Tg': None,
+        'final_density': None,
+        'final_temp': None,
+        'density_at_final_temp': None,
+        'nsteps': None,
+        'loop_time': None,
+        'wall_time': None
+    }
+
+    log_fname = os.path.join(run_dir, 'log.lammps')
+    failed = False
+    if os.path.isfile(log_fname):
+        row['state'] = 'running'
+        row['nsteps'] = 0
+        row['loop_time'] = 0.0
+        with open(log_fname, 'rt', errors='replace') as lines:
+            for line in lines:
+                if line.startswith('Loop time of'):
+                    match = re.match(
+                        r'Loop time of (\S+) on \d+ procs for (\d+) steps',
+                        line)
+                    if match:
+                        row['loop_time'] += float(match.group(1))
+                        row['nsteps'] += int(match.group(2))
+                elif line.startswith('Total wall time:'):
+                    h, m, s = line.split()[-1].split(':')
+                    row['wall_time'] = int(h) * 3600 + int(m) * 60 + int(s)
+                elif line.startswith('Equilibrated density:'):
+                    row['final_density'] = float(line.split()[-1])
+                elif line.startswith('ERROR'):
+                    failed = True
+
+    # A run started from a Library restart is equilibrated once it has
+    # started; before that it is only prepared
+    if os.path.isfile(os.path.join(run_dir, 'equilibrated.restart')) or (
+            os.path.isfile(log_fname)
+            and _reads_restart(os.path.join(run_dir, 'lmp.in'))):
+        row['state'] = 'equilibrated'
+    if row['wall_time'] is not None:
+        row['state'] = 'completed'
+    if failed:
+        row['state'] = 'failed'
+
+    tvd_fname = os.path.join(run_dir, 'temp_vs_density')
+    if os.path.isfile(tvd_fname):
+        try:
+            temp, density = read_temp_vs_density(tvd_fname)
+        except (ValueError, IndexError):
+            temp, density = [], []
+        if len(temp):
+            row['final_temp'] = float(temp[-1])
+            row['density_at_final_temp'] = float(density[-1])
+        if len(temp) >= 6:
+            row['Tg'] = float(fit_Tg(temp, density))
+
+    return row
+
+
+def _reads_restart(lmp_input):
+    # Inputs generated on a Library hit start from read_restart and never
+    # write a local equilibrated.restart
+    with open(lmp_input, 'rt') as lines:
+        return any(line.startswith('read_restart') for line in lines)
@@ -1,5 +1,10 @@
 from nnmdkit.util import Util
 
+# mpi_flags binding each rank to nthreads consecutive cores; {ppr} is the
+# number of ranks per node and {nthreads} the number of threads per rank
+OPENMPI_BINDING = '--map-by ppr:{ppr}:node:PE={nthreads} --bind-to core'
+MPICH_BINDING = '-ppn {ppr} -bind-to core:{nthreads}'
+
 
 class Job:
     '''nnmdkit.core.Job.Job
@@ -24,14 +29,48 @@ class Job:
 
         LAMMPS_EXEC: str
             Directory of the LAMMPS executable file
+
+        nthreads: int or str
+            Number of OpenMP threads per MPI rank, or 'auto' to choose it from natoms; default=1 (pure MPI)
+            Threads only speed up pair styles with an /omp variant, so nthreads other than 1 requires omp_pair_style
+
+        natoms: int
+            Number of atoms of the system, used when nthreads='auto'; default=None
+
+        omp_pair_style: bool
+            Whether the pair style of the LAMMPS executable has an /omp variant; default=False
+            -sf omp silently keeps the plain pair style otherwise, leaving the force work on a fraction of the cores
+
+        mpi_flags: str
+            Extra mpirun flags, formatted with ppr (ranks per node) and nthreads; default=None (plain mpirun)
+            e.g. OPENMPI_BINDING or MPICH_BINDING to bind each rank to its nthreads cores
     '''
-    def __init__(self, jobname, project, nodes, ppn, walltime, LAMMPS_EXEC):
+    def __init__(self,
+                 jobname,
+                 project,
+                 nodes,
+                 ppn,
+                 walltime,
+                 LAMMPS_EXEC,
+                 nthreads=1,
+                 natoms=None,
+                 omp_pair_style=False,
+                 mpi_flags=None):
         self.jobname = jobname
         self.project = project
         self.nodes = nodes
         self.ppn = ppn
         self.walltime = walltime
         self.LAMMPS_EXEC = LAMMPS_EXEC
+        if nthreads != 1 and not omp_pair_style:
+            raise ValueError(
+                'nthreads={} requires a pair style with an /omp variant; '
+                'set omp_pair_style=True if the executable has one'.format(
+                    nthreads))
+        self.omp_pair_style = omp_pair_style
+        self.mpi_flags = mpi_flags
+        self.nranks, self.nthreads = Util.hybrid_layout(
+            nodes, ppn, nthreads, natoms)
 
     def write_pbs(self, output_dir):
         Util.build_dir(output_dir)
@@ -46,5 +85,16 @@ class Job:
             f.write('#PBS -o out.$PBS_JOBID\n')
             f.write('\n')
             f.write('cd $PBS_O_WORKDIR\n')
-            f.write('mpirun -np {} {} -in lmp.in\n'.format(
-                int(self.nodes * self.ppn), self.LAMMPS_EXEC))
+            launch = 'mpirun -np {}'.format(self.nranks)
+            if self.mpi_flags is not None:
+                launch += ' ' + self.mpi_flags.format(
+                    ppr=self.ppn // self.nthreads, nthreads=self.nthreads)
+            if self.nthreads > 1:
+                # Pin the OpenMP threads of each rank to its cores
+                f.write('export OMP_NUM_THREADS={}\n'.format(self.nthreads))
+                f.write('export OMP_PLACES=cores\n')
+                f.write('export OMP_PROC_BIND=close\n')
+                f.write('{} {} -sf omp -pk omp {} -in lmp.in\n'.format(
+                    launch, self.LAMMPS_EXEC, self.nthreads))
+            else:
+                f.write('{} {} -in lmp.in\n'.format(launch, self.LAMMPS_EXEC))
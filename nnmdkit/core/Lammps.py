@@ -1,3 +1,4 @@
+import os
 from nnmdkit.util import Util
 
 
@@ -14,7 +15,9 @@ class Lammps:
             Neural network potential file name
 
         atom_style: str
-            LAMMPS aomt_style to use during simulation; default=full
+            LAMMPS atom_style to use during simulation (full, molecular or atomic); default=None (from the data file)
+            molecular and atomic give a lean profile with no charge and, for atomic, no mol column;
+            must match the Atoms # <style> hint of the data file when it has already been written
 
         units: str
             LAMMPS units to use during simulation; default=real
@@ -29,26 +32,37 @@ class Lammps:
             LAMMPS neighbor list checking frequency to use during simulation; default=1 fs
 
         thermo: int
-            LAMMPS thermo to use during simulation; default=1000 timestep
+            LAMMPS thermo to use during simulation; default=100 timestep (1000 for molecular/atomic)
+
+        thermo_style: str
+            Columns of the custom thermo_style; default=None (chosen from atom_style)
 
         pair_style: str
             LAMMPS pair_style to use during simulation; default=nn
 
         element: str
             Element order of the pair_style; default=C H
+
+        nranks: int
+            Number of MPI ranks, used for the processors grid and load balancing; default=None (LAMMPS default)
+            OpenMP threads are set on the command line by Job, so pass job.nranks for hybrid layouts
     '''
 
     def __init__(self,
                  data_fname,
                  NN_POTENTIAL,
-                 atom_style='full',
+                 atom_style=None,
                  units='metal',
                  timestep=0.001,
                  neighbor_skin=2.0,
                  neighbor_every=1,
-                 thermo=100,
+                 thermo=None,
+                 thermo_style=None,
                  pair_style='nn',
-                 element='C H'):
+                 element='C H',
+                 nranks=None):
+        if atom_style is not None and atom_style not in Util.ATOM_STYLES:
+            raise ValueError('unsupported atom_style: {}'.format(atom_style))
         self.data_fname = data_fname
         self.NN_POTENTIAL = NN_POTENTIAL
         self.atom_style = atom_style
@@ -57,8 +71,10 @@ class Lammps:
         self.neighbor_skin = neighbor_skin
         self.neighbor_every = neighbor_every
         self.thermo = thermo
+        self.thermo_style = thermo_style
         self.pair_style = pair_style
         self.element = element
+        self.nranks = nranks
 
     def add_procedure(self, procedure, **kwargs):
 
@@ -123,22 +139,46 @@ class Lammps:
             for i in self.eq_kwargs['eq_step']:
                 self.eq_kwargs['eq_totaltime'] += i[1]
 
-        # key = Tinit, Tfinal, Tinterval, step, pressure, Pdamp, Tdamp
+        # key = processors, comm_cutoff, style, dims, niter, thresh, every
+        # Applied automatically with these defaults when nranks > 1; style=None
+        # disables balancing and every=0 keeps only the initial balance
+        elif procedure == 'load_balance':
+            self.lb_kwargs = self._default_lb_kwargs()
+            Util.register_kwargs(self.lb_kwargs, kwargs)
+
+        # key = protocol, Tinit, Tfinal, Tinterval, step, cooling_rate, pressure, Pdamp, Tdamp
+        # protocol = stepwise: discrete NPT hold of length step at every Tinterval
+        # protocol = ramp: single NPT run cooled linearly at cooling_rate (K/ns),
+        #                  with temp_vs_density averaged over bins of width Tinterval
         elif procedure == 'Tg_measurement':
             self.Tg_kwargs = {
+                'protocol': 'stepwise',
                 'Tinit': 500,
                 'Tfinal': 100,
                 'Tinterval': 20,
                 'step': 1000000,
+                'cooling_rate': 50,
                 'pressure': 1,
                 'Tdamp': '$(100.0*dt)',
                 'Pdamp': '$(100.0*dt)'
             }
             Util.register_kwargs(self.Tg_kwargs, kwargs)
+            if self.Tg_kwargs['protocol'] not in ['stepwise', 'ramp']:
+                raise ValueError('unknown Tg_measurement protocol: {}'.format(
+                    self.Tg_kwargs['protocol']))
+            if self.Tg_kwargs['protocol'] == 'ramp':
+                if self.Tg_kwargs['Tinit'] <= self.Tg_kwargs['Tfinal']:
+                    raise ValueError('ramp requires Tinit > Tfinal')
+                if self.Tg_kwargs['cooling_rate'] <= 0:
+                    raise ValueError('ramp requires cooling_rate > 0')
+                if self.Tg_kwargs['Tinterval'] <= 0:
+                    raise ValueError('ramp requires Tinterval > 0')
 
     def write_input(self, output_dir):
 
         Util.build_dir(output_dir)
+        # Style actually written, from atom_style or the data file
+        self._atom_style = self.resolve_atom_style(output_dir)
 
         # Write settings file
         settings_fname = 'system.in.settings'
@@ -152,10 +192,9 @@ class Lammps:
             f.write('{:<15} delay 0 every {} check yes\n'.format(
                 'neigh_modify', self.neighbor_every))
             f.write('\n')
-            f.write(
-                '{:<15} custom step temp density vol press ke pe ebond evdwl ecoul elong\n'
-                .format('thermo_style'))
-            f.write('{:<15} {}\n'.format('thermo', self.thermo))
+            f.write('{:<15} custom {}\n'.format('thermo_style',
+                                                self._thermo_columns()))
+            f.write('{:<15} {}\n'.format('thermo', self._thermo()))
             f.write('{:<15} {}\n'.format('timestep', self.timestep))
 
         # Write LAMMPS input file
@@ -166,15 +205,33 @@ class Lammps:
             f.write('\n')
 
             f.write('### Initialization\n')
-            f.write('{:<15} full\n'.format('atom_style'))
-            f.write('{:<15} {}\n'.format('units', self.units))
-            f.write('{:<15} {}\n'.format('read_data', self.data_fname))
+            self._write_decomposition(f, output_dir)
+
+            # On a library hit, start from the stored equilibrated state and
+            # skip minimization and equilibration
+            key = restart = None
+            if hasattr(self, 'library'):
+                key, params = self.library.key(self.library_system, self,
+                                               output_dir)
+                restart = self.library.lookup(key)
+                if restart is None:
+                    self.library.write_params(key, params)
+            if restart is not None:
+                f.write('{:<15} {}\n'.format('read_restart', restart))
+            else:
+                f.write('{:<15} {}\n'.format('atom_style', self._atom_style))
+                f.write('{:<15} {}\n'.format('units', self.units))
+                f.write('{:<15} {}\n'.format('read_data', self.data_fname))
             f.write('{:<15} {}\n'.format('include', settings_fname))
+            if restart is not None:
+                f.write('{:<15} "Equilibrated density: $(density)"\n'.format(
+                    'print'))
             f.write('\n')
+            self._write_balance(f)
             f.write('\n')
 
             # If minimization is added to the lammps procedure
-            if hasattr(self, 'min_kwargs'):
+            if hasattr(self, 'min_kwargs') and restart is None:
                 f.write('### Minimization\n')
                 f.write('{:<15} {}\n'.format('min_style',
                                              self.min_kwargs['min_style']))
@@ -187,11 +244,11 @@ class Lammps:
                 f.write('\n')
 
             # If equilibration is added to the lammps procedure
-            if hasattr(self, 'eq_kwargs'):
+            if hasattr(self, 'eq_kwargs') and restart is None:
                 f.write('### Equilibration\n')
                 f.write(
-                    '{:<15} dump1 all custom 10000 equil.lammpstrj id mol type q xs ys zs ix iy iz\n'
-                    .format('dump'))
+                    '{:<15} dump1 all custom 10000 equil.lammpstrj {}\n'.format(
+                        'dump', self._dump_columns()))
                 f.write('{:<15} {} equilibrated.restart\n'.format(
                     'restart', self.eq_kwargs['eq_totaltime']))
                 f.write('\n')
@@ -209,42 +266,212 @@ class Lammps:
                     f.write('{:<15} {}\n'.format('run', i[1]))
                     f.write('{:<15} step{}\n'.format('unfix', n + 1))
                     f.write('\n')
+                # Density at Tfinal/Pfinal, picked up by Database
+                f.write('{:<15} "Equilibrated density: $(density)"\n'.format(
+                    'print'))
                 f.write('{:<15} dump1\n'.format('undump'))
                 f.write('{:<15} 0\n'.format('reset_timestep'))
+                if key is not None:
+                    # Register the equilibrated state in the library; written
+                    # under a temporary name so it only becomes a hit once
+                    # complete
+                    path = self.library.restart_path(key)
+                    f.write('{:<15} {}.tmp\n'.format('write_restart', path))
+                    f.write('{:<15} mv {}.tmp {}\n'.format(
+                        'shell', path, path))
                 f.write('\n')
                 f.write('\n')
 
-            # If equilibration is added to the lammps procedure
+            # If Tg measurement is added to the lammps procedure
             if hasattr(self, 'Tg_kwargs'):
-                step = self.Tg_kwargs['step']
-                f.write('### Production - Tg measurement\n')
-                f.write(
-                    '{:<15} dump2 all custom 10000 production.lammpstrj id mol type q xs ys zs ix iy iz\n'
-                    .format('dump'))
-                f.write('{:<15} {} production.restart\n'.format(
-                    'restart', step))
-                f.write('{:<15} Rho equal density\n'.format('variable'))
-                f.write('{:<15} Temp equal temp\n'.format('variable'))
-                f.write(
-                    '{:<15} fDENS all ave/time {} {} {} v_Temp v_Rho file temp_vs_density\n'
-                    .format('fix', int(step / 100 / 4), 100, step))
-                f.write('\n')
-
-                f.write('{:<15} loop\n'.format('label'))
-                f.write('{:<15} a loop {}\n'.format(
-                    'variable',
-                    int((self.Tg_kwargs['Tinit'] - self.Tg_kwargs['Tfinal']) /
-                        self.Tg_kwargs['Tinterval'] + 1)))
-                f.write('{:<15} b equal {}-{}*($a-1)\n'.format(
-                    'variable', self.Tg_kwargs['Tinit'],
-                    self.Tg_kwargs['Tinterval']))
-                f.write(
-                    '{:<15} fNPT all npt temp $b $b {} iso {} {} {}\n'.format(
-                        'fix', self.Tg_kwargs['Tdamp'],
-                        self.Tg_kwargs['pressure'], self.Tg_kwargs['pressure'],
-                        self.Tg_kwargs['Pdamp']))
-                f.write('{:<15} {}\n'.format('run', step))
-                f.write('{:<15} fNPT\n'.format('unfix'))
-                f.write('{:<15} a\n'.format('next'))
-                f.write('{:<15} SELF loop\n'.format('jump'))
-                f.write('{:<15} a delete\n'.format('variable'))
+                if self.Tg_kwargs['protocol'] == 'ramp':
+                    self._write_Tg_ramp(f)
+                else:
+                    self._write_Tg_stepwise(f)
+
+    def resolve_atom_style(self, output_dir='.'):
+        # The data file, once written, decides the style: an unset atom_style
+        # is taken from it (full if it is not written yet) and a different
+        # one would fail in read_data
+        data_path = os.path.join(output_dir, self.data_fname)
+        data_style = None
+        if os.path.isfile(data_path):
+            data_style = Util.read_atom_style(data_path)
+        if self.atom_style is None:
+            return data_style or 'full'
+        if data_style is not None and data_style != self.atom_style:
+            raise ValueError('atom_style {} does not match {} data in {}'.format(
+                self.atom_style, data_style, data_path))
+        return self.atom_style
+
+    def _thermo(self):
+        if self.thermo is not None:
+            return self.thermo
+        # The lean styles also print thermo less often
+        return 100 if self._atom_style == 'full' else 1000
+
+    def _thermo_columns(self):
+        if self.thermo_style is not None:
+            return self.thermo_style
+        # Bonded and Coulomb terms are only meaningful with atom_style full
+        if self._atom_style == 'full':
+            return 'step temp density vol press ke pe ebond evdwl ecoul elong'
+        return 'step temp density vol press pe'
+
+    def _dump_columns(self):
+        if self._atom_style == 'full':
+            return 'id mol type q xs ys zs ix iy iz'
+        elif self._atom_style == 'molecular':
+            return 'id mol type xs ys zs ix iy iz'
+        return 'id type xs ys zs ix iy iz'
+
+    def _default_lb_kwargs(self):
+        return {
+            'processors': None,
+            'comm_cutoff': None,
+            'style': 'shift',
+            'dims': 'xyz',
+            'niter': 10,
+            'thresh': 1.1,
+            'every': 10000
+        }
+
+    def _lb_kwargs(self):
+        if hasattr(self, 'lb_kwargs'):
+            return self.lb_kwargs
+        if self.nranks is not None and self.nranks > 1:
+            return self._default_lb_kwargs()
+        return None
+
+    def _write_decomposition(self, f, output_dir):
+        lb_kwargs = self._lb_kwargs()
+        if lb_kwargs is not None and lb_kwargs['processors'] is not None:
+            f.write('{:<15} {}\n'.format('processors',
+                                         lb_kwargs['processors']))
+        elif self.nranks is not None:
+            # Shape the processor grid after the box in the data file, if it
+            # has already been written
+            box = None
+            data_path = os.path.join(output_dir, self.data_fname)
+            if os.path.isfile(data_path):
+                box = Util.read_box(data_path)
+            f.write('{:<15} {} {} {}\n'.format(
+                'processors', *Util.processor_grid(self.nranks, box)))
+        if lb_kwargs is not None and lb_kwargs['style'] == 'rcb':
+            f.write('{:<15} tiled\n'.format('comm_style'))
+
+    def _write_balance(self, f):
+        lb_kwargs = self._lb_kwargs()
+        if lb_kwargs is None:
+            return
+        if lb_kwargs['comm_cutoff'] is not None:
+            f.write('{:<15} cutoff {}\n'.format('comm_modify',
+                                                lb_kwargs['comm_cutoff']))
+        if lb_kwargs['style'] is None:
+            return
+        if lb_kwargs['style'] == 'rcb':
+            args = 'rcb'
+        else:
+            args = 'shift {} {} {}'.format(lb_kwargs['dims'],
+                                           lb_kwargs['niter'],
+                                           lb_kwargs['thresh'])
+        f.write('{:<15} {} {}\n'.format('balance', lb_kwargs['thresh'], args))
+        # Keep rebalancing while the box shrinks during equilibration
+        if lb_kwargs['every'] > 0:
+            f.write('{:<15} fBAL all balance {} {} {}\n'.format(
+                'fix', lb_kwargs['every'], lb_kwargs['thresh'], args))
+
+    def _write_Tg_stepwise(self, f):
+        step = self.Tg_kwargs['step']
+        f.write('### Production - Tg measurement\n')
+        f.write('{:<15} dump2 all custom 10000 production.lammpstrj {}\n'.format(
+            'dump', self._dump_columns()))
+        f.write('{:<15} {} production.restart\n'.format('restart', step))
+        f.write('{:<15} Rho equal density\n'.format('variable'))
+        f.write('{:<15} Temp equal temp\n'.format('variable'))
+        f.write(
+            '{:<15} fDENS all ave/time {} {} {} v_Temp v_Rho file temp_vs_density\n'
+            .format('fix', int(step / 100 / 4), 100, step))
+        f.write('\n')
+
+        f.write('{:<15} loop\n'.format('label'))
+        f.write('{:<15} a loop {}\n'.format(
+            'variable',
+            int((self.Tg_kwargs['Tinit'] - self.Tg_kwargs['Tfinal']) /
+                self.Tg_kwargs['Tinterval'] + 1)))
+        f.write('{:<15} b equal {}-{}*($a-1)\n'.format(
+            'variable', self.Tg_kwargs['Tinit'], self.Tg_kwargs['Tinterval']))
+        f.write('{:<15} fNPT all npt temp $b $b {} iso {} {} {}\n'.format(
+            'fix', self.Tg_kwargs['Tdamp'], self.Tg_kwargs['pressure'],
+            self.Tg_kwargs['pressure'], self.Tg_kwargs['Pdamp']))
+        f.write('{:<15} {}\n'.format('run', step))
+        f.write('{:<15} fNPT\n'.format('unfix'))
+        f.write('{:<15} a\n'.format('next'))
+        f.write('{:<15} SELF loop\n'.format('jump'))
+        f.write('{:<15} a delete\n'.format('variable'))
+
+    def use_library(self, library, system):
+        # Reuse or register the equilibrated state of system in library; the
+        # key is computed in write_input, after all procedures are added
+        self.library = library
+        self.library_system = system
+
+    def total_steps(self, output_dir='.'):
+        # Number of MD steps of equilibration and Tg measurement (minimization
+        # is not counted); equilibration is free on a library hit. output_dir
+        # is the run directory a relative NN_POTENTIAL is resolved against
+        step = 0
+        if hasattr(self, 'eq_kwargs') and not self._library_hit(output_dir):
+            step += self.eq_kwargs['eq_totaltime']
+        if hasattr(self, 'Tg_kwargs'):
+            if self.Tg_kwargs['protocol'] == 'ramp':
+                step += self._ramp_steps()[3]
+            else:
+                step += self.Tg_kwargs['step'] * int(
+                    (self.Tg_kwargs['Tinit'] - self.Tg_kwargs['Tfinal']) /
+                    self.Tg_kwargs['Tinterval'] + 1)
+        return step
+
+    def _library_hit(self, output_dir):
+        if not hasattr(self, 'library'):
+            return False
+        key, _ = self.library.key(self.library_system, self, output_dir)
+        return self.library.lookup(key) is not None
+
+    def _ramp_steps(self):
+        Tinit = self.Tg_kwargs['Tinit']
+        Tfinal = self.Tg_kwargs['Tfinal']
+
+        # Each temperature bin of width Tinterval is averaged into one line of
+        # temp_vs_density, so the total run is a whole number of bins
+        nbins = max(int(round((Tinit - Tfinal) / self.Tg_kwargs['Tinterval'])),
+                    1)
+        bin_time = (Tinit - Tfinal) / self.Tg_kwargs['cooling_rate'] / nbins
+        bin_step = Util.ns_to_steps(bin_time, self.timestep, self.units)
+        nevery = max(bin_step // 100, 1)
+        nrepeat = bin_step // nevery
+        bin_step = nevery * nrepeat
+        return nevery, nrepeat, bin_step, bin_step * nbins
+
+    def _write_Tg_ramp(self, f):
+        Tinit = self.Tg_kwargs['Tinit']
+        Tfinal = self.Tg_kwargs['Tfinal']
+        nevery, nrepeat, bin_step, step = self._ramp_steps()
+
+        f.write('### Production - Tg measurement (continuous cooling)\n')
+        f.write('{:<15} dump2 all custom 10000 production.lammpstrj {}\n'.format(
+            'dump', self._dump_columns()))
+        f.write('{:<15} {} production.restart\n'.format('restart', bin_step))
+        f.write('{:<15} Rho equal density\n'.format('variable'))
+        f.write('{:<15} Temp equal temp\n'.format('variable'))
+        f.write(
+            '{:<15} fDENS all ave/time {} {} {} v_Temp v_Rho file temp_vs_density\n'
+            .format('fix', nevery, nrepeat, bin_step))
+        f.write('\n')
+
+        f.write('{:<15} fNPT all npt temp {} {} {} iso {} {} {}\n'.format(
+            'fix', Tinit, Tfinal, self.Tg_kwargs['Tdamp'],
+            self.Tg_kwargs['pressure'], self.Tg_kwargs['pressure'],
+            self.Tg_kwargs['Pdamp']))
+        f.write('{:<15} {}\n'.format('run', step))
+        f.write('{:<15} fNPT\n'.format('unfix'))
@@ -0,0 +1,91 @@
+import os
+import json
+import shutil
+import hashlib
+from nnmdkit.util import Util
+
+
+class Library:
+    '''nnmdkit.core.Library.Library
+
+    Template object to contain a library of equilibrated restart files
+
+    Entries are keyed by the system (SMILES, molecular weight, number of
+    atoms and initial density), the potential (including a hash of the
+    potential file contents) and the minimization and equilibration
+    parameters, so a polymer equilibrated once at a given
+    Tfinal/Pfinal can be reused by later studies without repeating the
+    equilibration.
+
+    Attributes:
+        library_dir: str
+            Directory holding the restart files; shared by all studies
+    '''
+    def __init__(self, library_dir):
+        self.library_dir = os.path.abspath(library_dir)
+        self._potential_hashes = {}
+        Util.build_dir(self.library_dir)
+
+    def key(self, system, lammps, output_dir='.'):
+        # A relative NN_POTENTIAL and the data file are resolved against
+        # output_dir, the directory LAMMPS runs in
+        params = {
+            'system': [system.smiles, system.mw, system.ntotal, system.density],
+            'potential': [
+                self.potential_hash(lammps.NN_POTENTIAL, output_dir),
+                lammps.pair_style, lammps.element, lammps.units,
+                lammps.resolve_atom_style(output_dir), lammps.timestep
+            ],
+            'minimization': getattr(lammps, 'min_kwargs', None),
+            'equilibration': {
+                k: v
+                for k, v in getattr(lammps, 'eq_kwargs', {}).items()
+                if k != 'eq_totaltime'
+            }
+        }
+        return hashlib.sha1(
+            json.dumps(params, sort_keys=True,
+                       default=str).encode()).hexdigest(), params
+
+    def potential_hash(self, NN_POTENTIAL, output_dir='.'):
+        # Two potentials saved under the same name must never share entries,
+        # so the key depends on the file contents; hashes are cached per
+        # file, size and mtime
+        path = os.path.join(output_dir, os.path.expanduser(NN_POTENTIAL))
+        if not os.path.isfile(path):
+            raise FileNotFoundError(
+                'potential file {} is required to key the library'.format(
+                    path))
+        stat = os.stat(path)
+        cache = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        if cache not in self._potential_hashes:
+            h = hashlib.sha1()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    h.update(block)
+            self._potential_hashes[cache] = h.hexdigest()
+        return self._potential_hashes[cache]
+
+    def restart_path(self, key):
+        return os.path.join(self.library_dir, '{}.restart'.format(key))
+
+    def lookup(self, key):
+        path = self.restart_path(key)
+        if os.path.isfile(path):
+            return path
+        return None
+
+    def register(self, key, restart_fname, params=None):
+        # Copy to a temporary name first so a partially copied file is never
+        # seen as a library hit
+        tmp = '{}.{}.tmp'.format(self.restart_path(key), os.getpid())
+        shutil.copyfile(restart_fname, tmp)
+        os.replace(tmp, self.restart_path(key))
+        if params is not None:
+            self.write_params(key, params)
+        return self.restart_path(key)
+
+    def write_params(self, key, params):
+        with open(os.path.join(self.library_dir, '{}.json'.format(key)),
+                  'w') as f:
+            json.dump(params, f, indent=1, default=str)
@@ -0,0 +1,101 @@
+import math
+from nnmdkit.util import Util
+from rdkit.Chem import Descriptors, MolFromSmiles
+
+
+class Screening:
+    '''nnmdkit.core.Screening.Screening
+
+    Template object to contain cost-aware prioritization settings of a campaign
+
+    Each entry is scored by its expected information per unit of compute,
+    weight / cost, where cost is the predicted atom count times the total MD
+    steps of its Lammps procedures, and weight favors a predicted Tg close to
+    Tg_target (all entries weigh the same if Tg_target is None).
+
+    Attributes:
+        surrogate: callable
+            Function returning an estimated Tg (K) from a repeat-unit SMILES; default=descriptor_Tg
+
+        Tg_target: float
+            Tg (K) of most interest; default=None (cheapest systems first)
+
+        Tg_width: float
+            Width (K) of the Gaussian weight around Tg_target; default=50
+
+        budget: float
+            Total cost (atom x steps) to spend; entries beyond it are pruned; default=None (keep all)
+    '''
+    def __init__(self,
+                 surrogate=None,
+                 Tg_target=None,
+                 Tg_width=50,
+                 budget=None):
+        self.surrogate = surrogate if surrogate is not None else descriptor_Tg
+        self.Tg_target = Tg_target
+        self.Tg_width = Tg_width
+        self.budget = budget
+
+    def estimate(self, system, lammps, output_dir='.'):
+        # output_dir is the run directory of the entry, against which a
+        # relative NN_POTENTIAL is resolved when lammps uses a Library
+        natoms = system.predict_natoms()
+        nsteps = lammps.total_steps(output_dir)
+        Tg = self.surrogate(system.smiles)
+        weight = 1.0
+        if self.Tg_target is not None:
+            weight = math.exp(-0.5 * ((Tg - self.Tg_target) / self.Tg_width)**2)
+        cost = natoms * nsteps
+        return {
+            'smiles': system.smiles,
+            'Tg_pred': Tg,
+            'natoms': natoms,
+            'nsteps': nsteps,
+            'cost': cost,
+            'score': weight / cost if cost else weight
+        }
+
+    def rank(self, entries, output_dir=None, output_fname='ranking.csv'):
+        '''Order (system, lammps) pairs by score and prune them to the budget
+
+        Entries may also be (system, lammps, run_dir), so that Library hits
+        of a relative NN_POTENTIAL are costed from each run directory.
+        Returns the estimates sorted from highest to lowest score, each with
+        its rank (usable as WorkQueue priority) and whether it fits in the
+        budget. If output_dir is given the ranking is also written there as a
+        CSV file, next to the campaign inputs.
+        '''
+        ranking = sorted([self.estimate(*i) for i in entries],
+                         key=lambda x: x['score'],
+                         reverse=True)
+        spent = 0
+        for n, i in enumerate(ranking):
+            i['rank'] = n
+            i['selected'] = self.budget is None or spent + i['cost'] <= self.budget
+            if i['selected']:
+                spent += i['cost']
+
+        if output_dir is not None:
+            Util.build_dir(output_dir)
+            with open(output_dir + '/' + output_fname, 'w') as f:
+                f.write('rank,smiles,Tg_pred,natoms,nsteps,cost,score,selected\n')
+                for i in ranking:
+                    f.write('{},{},{:.1f},{},{},{},{:.6e},{}\n'.format(
+                        i['rank'], i['smiles'], i['Tg_pred'], i['natoms'],
+                        i['nsteps'], i['cost'], i['score'], int(i['selected'])))
+        return ranking
+
+
+def descriptor_Tg(smiles):
+    # Crude descriptor heuristic, only meant to order candidates before any
+    # simulation: aromatic and ring atoms stiffen the chain and raise Tg,
+    # rotatable bonds per heavy atom make it more flexible and lower it. Pass
+    # a fitted model as Screening(surrogate=...) for quantitative screening.
+    mol = MolFromSmiles(smiles)
+    heavy = [x for x in mol.GetAtoms() if x.GetAtomicNum() > 1]
+    nheavy = max(len(heavy), 1)
+    aromatic = len([x for x in heavy if x.GetIsAromatic()]) / nheavy
+    ring = len([x for x in heavy
+                if x.IsInRing() and not x.GetIsAromatic()]) / nheavy
+    rotatable = Descriptors.NumRotatableBonds(mol) / nheavy
+    return 200 + 200 * aromatic + 100 * ring - 100 * rotatable
@@ -1,7 +1,7 @@
 import os
 import glob
 from nnmdkit.util import Util
-from rdkit.Chem import Descriptors, MolFromSmiles
+from rdkit.Chem import AddHs, Descriptors, MolFromSmiles
 from subprocess import call
 
 
@@ -29,13 +29,32 @@ class System:
         self.ntotal = ntotal
         self.density = density
 
+    def repeat_unit(self):
+        # Molecular weight of the repeat unit and number of repeat units per chain
+        RU_mw = Descriptors.ExactMolWt(MolFromSmiles(self.smiles))
+        chainlength = int(self.mw / RU_mw)
+        return RU_mw, chainlength
+
+    def predict_natoms(self, terminator='*[H]'):
+        # Expected number of atoms of the system built by EMC: whole chains of
+        # chainlength repeat units capped by two terminators, up to ntotal
+        _, chainlength = self.repeat_unit()
+        RU_atoms = _count_atoms(self.smiles)
+        chain_atoms = chainlength * RU_atoms + 2 * _count_atoms(terminator)
+        nchains = max(int(round(self.ntotal / chain_atoms)), 1)
+        return nchains * chain_atoms
+
     def write_data(self,
                    output_dir,
                    output_prefix='system',
                    tmp_ff='opls-aa',
                    terminator='*[H]',
+                   atom_style='full',
                    cleanup=True):
 
+        if atom_style not in Util.ATOM_STYLES:
+            raise ValueError('unsupported atom_style: {}'.format(atom_style))
+
         Util.build_dir(output_dir)
 
         previous_dir = os.getcwd()
@@ -43,8 +62,7 @@ class System:
 
         # Write .esh file required to run EMC
         tmp_eshfile = '{}.esh'.format(output_prefix)
-        RU_mw = Descriptors.ExactMolWt(MolFromSmiles(self.smiles))
-        chainlength = int(self.mw / RU_mw)
+        RU_mw, chainlength = self.repeat_unit()
         with open(tmp_eshfile, 'w') as f:
             f.write('#!/usr/bin/env emc_setup.pl\n')
             f.write('ITEM OPTIONS\n')
@@ -132,14 +150,27 @@ class System:
             for n, i in enumerate(unique_mass):
                 out.write('{:>8} {:>10}\n'.format(n + 1, i))
             out.write('\n')
-            out.write('Atoms\n')
+            # Bonds and charges are dropped, so molecular (mol ids kept) and
+            # atomic data carry the same information with fewer columns
+            if atom_style == 'full':
+                out.write('Atoms\n')
+            else:
+                out.write('Atoms # {}\n'.format(atom_style))
             out.write('\n')
             for line in atomlines:
                 fields = line.split()
                 new_atomtype = typeconvertdict[fields[2]]
-                out.write(
-                    '{0:>8} {1:>7} {atomtype:>3} {charge:>7} {4:>14} {5:>14} {6:>14}\n'
-                    .format(*fields, atomtype=new_atomtype, charge=0))
+                if atom_style == 'full':
+                    out.write(
+                        '{0:>8} {1:>7} {atomtype:>3} {charge:>7} {4:>14} {5:>14} {6:>14}\n'
+                        .format(*fields, atomtype=new_atomtype, charge=0))
+                elif atom_style == 'molecular':
+                    out.write(
+                        '{0:>8} {1:>7} {atomtype:>3} {4:>14} {5:>14} {6:>14}\n'
+                        .format(*fields, atomtype=new_atomtype))
+                else:
+                    out.write('{0:>8} {atomtype:>3} {4:>14} {5:>14} {6:>14}\n'.
+                              format(*fields, atomtype=new_atomtype))
 
         # Clean up all EMC generated files except for the data file
         if cleanup:
@@ -157,3 +188,9 @@ class System:
 
         os.chdir(previous_dir)
         return data_fname
+
+
+def _count_atoms(smiles):
+    # Number of atoms including hydrogens, excluding * connection points
+    mol = AddHs(MolFromSmiles(smiles))
+    return len([x for x in mol.GetAtoms() if x.GetAtomicNum() > 0])
@@ -0,0 +1,244 @@
+import os
+import json
+import time
+import uuid
+import socket
+import threading
+import traceback
+from nnmdkit.util import Util
+from nnmdkit.core.System import System
+from nnmdkit.core.Lammps import Lammps
+from nnmdkit.core.Job import Job
+
+# Added to priorities so that they sort as 10-digit non-negative keys
+PRIORITY_OFFSET = 10**9
+
+
+class WorkQueue:
+    '''nnmdkit.core.WorkQueue.WorkQueue
+
+    Template object to contain a filesystem-backed queue of campaign preparation tasks
+
+    Each task is a JSON file that moves between the pending, running, done and
+    failed subdirectories of queue_dir. Tasks are claimed with an atomic
+    rename, so any number of workers on nodes sharing queue_dir can pull from
+    the same queue without an external service; start a worker on each node
+    with python -m nnmdkit.core.worker <queue_dir>. Every claim renames the task
+    to a unique name in running, so a worker that lost its lease can no
+    longer touch the task once it has been claimed again.
+
+    Attributes:
+        queue_dir: str
+            Shared directory holding the queue
+
+        lease: float
+            Seconds a running task may go without a heartbeat before it is requeued; default=600
+
+        max_retries: int
+            Number of attempts of a task before it is moved to failed; default=3
+    '''
+    def __init__(self, queue_dir, lease=600, max_retries=3):
+        self.queue_dir = os.path.abspath(queue_dir)
+        self.lease = lease
+        self.max_retries = max_retries
+        Util.build_dir(self.queue_dir)
+        for state in ['pending', 'running', 'done', 'failed']:
+            Util.build_dir(os.path.join(self.queue_dir, state))
+
+    def submit(self,
+               output_dir,
+               system,
+               job,
+               lammps=None,
+               procedures=None,
+               write_data=None,
+               priority=0):
+        '''Add a System.write_data -> Lammps.write_input -> Job.write_pbs task
+
+        system, lammps and job are keyword arguments of the System, Lammps and
+        Job constructors (data_fname of Lammps is filled in by the worker),
+        procedures is a list of [procedure, kwargs] passed to
+        Lammps.add_procedure and write_data holds extra keyword arguments of
+        System.write_data. Tasks with a lower priority are claimed first;
+        priority must be an integer in (-10**9, 10**9).
+        '''
+        if int(priority) != priority or abs(priority) >= PRIORITY_OFFSET:
+            raise ValueError('priority must be an integer in (-{0}, {0})'.format(
+                PRIORITY_OFFSET))
+        task = {
+            'id': uuid.uuid4().hex,
+            'output_dir': os.path.abspath(output_dir),
+            'system': system,
+            'write_data': write_data or {},
+            'lammps': lammps or {},
+            'procedures': procedures or [],
+            'job': job,
+            'attempts': 0,
+            'error': None
+        }
+        # Offset into a non-negative, fixed-width key so that file names sort
+        # in priority order, negative priorities included
+        fname = '{:010d}_{}.json'.format(int(priority) + PRIORITY_OFFSET,
+                                         task['id'])
+        self._write_task(os.path.join(self.queue_dir, 'pending', fname), task)
+        return task['id']
+
+    def claim(self):
+        pending_dir = os.path.join(self.queue_dir, 'pending')
+        for fname in sorted(os.listdir(pending_dir)):
+            if not fname.endswith('.json'):
+                continue
+            src = os.path.join(pending_dir, fname)
+            claim = '{}.{}'.format(self.worker_id(), uuid.uuid4().hex)
+            dst = os.path.join(self.queue_dir, 'running',
+                               '{}.{}.json'.format(_stem(fname), claim))
+            try:
+                # Refresh mtime first so the lease starts at the claim
+                os.utime(src)
+                os.rename(src, dst)
+            except FileNotFoundError:
+                # Claimed by another worker in the meantime
+                continue
+            with open(dst, 'rt') as f:
+                task = json.load(f)
+            task['claim'] = claim
+            self._write_task(dst, task)
+            return dst, task
+        return None
+
+    def complete(self, path, task):
+        return self._move(path, 'done', task)
+
+    def fail(self, path, task, error):
+        task['attempts'] += 1
+        task['error'] = error
+        if task['attempts'] < self.max_retries:
+            return self._move(path, 'pending', task)
+        return self._move(path, 'failed', task)
+
+    def recover(self):
+        '''Requeue running tasks whose lease has expired (crashed workers)'''
+        running_dir = os.path.join(self.queue_dir, 'running')
+        nrecovered = 0
+        for fname in os.listdir(running_dir):
+            # Also pick up tasks left behind by a worker that died mid-move
+            if fname.endswith('.tmp'):
+                continue
+            path = os.path.join(running_dir, fname)
+            try:
+                if time.time() - os.stat(path).st_mtime < self.lease:
+                    continue
+                with open(path, 'rt') as f:
+                    task = json.load(f)
+            except (FileNotFoundError, ValueError):
+                continue
+            if self.fail(path, task, 'lease expired'):
+                nrecovered += 1
+        return nrecovered
+
+    def status(self):
+        return {
+            state: len([
+                x for x in os.listdir(os.path.join(self.queue_dir, state))
+                if x.endswith('.json')
+            ])
+            for state in ['pending', 'running', 'done', 'failed']
+        }
+
+    def run_worker(self, max_tasks=None, poll=30):
+        '''Process tasks until the queue is drained or max_tasks are done
+
+        While other workers still hold running tasks, the worker waits for
+        them since an expired lease puts them back into pending.
+        '''
+        ntasks = 0
+        while max_tasks is None or ntasks < max_tasks:
+            self.recover()
+            claimed = self.claim()
+            if claimed is None:
+                if self.status()['running'] == 0:
+                    break
+                time.sleep(poll)
+                continue
+
+            path, task = claimed
+            stop = threading.Event()
+            heartbeat = threading.Thread(target=self._heartbeat,
+                                         args=(path, stop),
+                                         daemon=True)
+            heartbeat.start()
+            try:
+                self.process(task)
+            except Exception:
+                self.fail(path, task, traceback.format_exc())
+            else:
+                self.complete(path, task)
+            finally:
+                stop.set()
+                heartbeat.join()
+            ntasks += 1
+        return ntasks
+
+    def process(self, task):
+        previous_dir = os.getcwd()
+        try:
+            os.makedirs(task['output_dir'], exist_ok=True)
+            # write_data ignores EMC exit codes, so a data file left by an
+            # earlier attempt must not be taken for the result of this one
+            data = os.path.join(
+                task['output_dir'], '{}.data'.format(task['write_data'].get(
+                    'output_prefix', 'system')))
+            if os.path.isfile(data):
+                os.remove(data)
+            system = System(**task['system'])
+            data = system.write_data(task['output_dir'], **task['write_data'])
+            if not os.path.isfile(os.path.join(task['output_dir'], data)):
+                raise RuntimeError('EMC did not produce {}'.format(data))
+
+            lmp = Lammps(data, **task['lammps'])
+            for procedure, kwargs in task['procedures']:
+                lmp.add_procedure(procedure, **kwargs)
+            lmp.write_input(task['output_dir'])
+
+            job = Job(**task['job'])
+            job.write_pbs(task['output_dir'])
+        finally:
+            os.chdir(previous_dir)
+
+    def worker_id(self):
+        return '{}.{}'.format(socket.gethostname(), os.getpid())
+
+    def _heartbeat(self, path, stop):
+        while not stop.wait(self.lease / 3):
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                return
+
+    def _move(self, path, state, task):
+        # path is the unique name of one claim; take ownership with a rename
+        # first, which fails if the claim was recovered in the meantime (even
+        # if the task has been claimed again under another name)
+        moving = '{}.moving'.format(path)
+        try:
+            os.rename(path, moving)
+        except FileNotFoundError:
+            return False
+        task['claim'] = None
+        self._write_task(moving, task)
+        os.rename(
+            moving,
+            os.path.join(self.queue_dir, state,
+                         '{}.json'.format(_stem(os.path.basename(path)))))
+        return True
+
+    def _write_task(self, path, task):
+        tmp = '{}.{}.tmp'.format(path, self.worker_id())
+        with open(tmp, 'wt') as f:
+            json.dump(task, f, indent=1)
+        os.replace(tmp, path)
+
+
+def _stem(fname):
+    # <priority>_<id> part of a task file name, without claim or suffixes
+    return fname.split('.', 1)[0]
@@ -0,0 +1,12 @@
+import sys
+from nnmdkit.core.WorkQueue import WorkQueue
+
+
+def main():
+    # Kept apart from WorkQueue, which the package already imports, so that
+    # python -m nnmdkit.core.worker <queue_dir> runs it without a warning
+    WorkQueue(sys.argv[1]).run_worker()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,19 @@
 import os
 
+# Time unit of each LAMMPS units style, in ns
+TIME_UNITS = {
+    'real': 1e-6,
+    'metal': 1e-3,
+    'si': 1e9,
+    'cgs': 1e9,
+    'electron': 1e-6,
+    'micro': 1e3,
+    'nano': 1
+}
+
+# atom_style values System.write_data and Lammps support
+ATOM_STYLES = ['full', 'molecular', 'atomic']
+
 
 def build_dir(output_dir):
     try:
@@ -12,3 +26,84 @@ def register_kwargs(self_kwargs, input_kwargs):
     for key in self_kwargs:
         if key in input_kwargs:
             self_kwargs[key] = input_kwargs.get(key)
+
+
+def ns_to_steps(time_ns, timestep, units):
+    if units not in TIME_UNITS:
+        raise ValueError(
+            'time conversion not supported for units {}'.format(units))
+    return int(round(time_ns / (timestep * TIME_UNITS[units])))
+
+
+def hybrid_layout(nodes,
+                  ppn,
+                  nthreads=1,
+                  natoms=None,
+                  atoms_per_rank=1000,
+                  max_threads=8):
+    # Split the cores of each node into MPI ranks x OpenMP threads
+    if nthreads == 'auto':
+        # Use the fewest threads per rank that still leave every rank with at
+        # least atoms_per_rank atoms; small systems get more threads per rank,
+        # up to max_threads beyond which OpenMP scaling usually degrades
+        nthreads = 1
+        if natoms is not None:
+            for n in range(1, min(ppn, max_threads) + 1):
+                if ppn % n:
+                    continue
+                nthreads = n
+                if natoms / (nodes * ppn / n) >= atoms_per_rank:
+                    break
+    if ppn % nthreads:
+        raise ValueError('ppn={} is not divisible by nthreads={}'.format(
+            ppn, nthreads))
+    return nodes * ppn // nthreads, nthreads
+
+
+def processor_grid(nranks, box=None):
+    # Factorize nranks into the Px x Py x Pz grid whose subdomains have the
+    # smallest surface area, i.e. the least ghost-atom communication; without
+    # box lengths the box is taken as cubic
+    if box is None:
+        box = [1.0, 1.0, 1.0]
+    best = None
+    for px in range(1, nranks + 1):
+        if nranks % px:
+            continue
+        for py in range(1, nranks // px + 1):
+            if (nranks // px) % py:
+                continue
+            pz = nranks // px // py
+            lx, ly, lz = box[0] / px, box[1] / py, box[2] / pz
+            area = lx * ly + ly * lz + lx * lz
+            if best is None or area < best[0]:
+                best = (area, [px, py, pz])
+    return best[1]
+
+
+def read_box(data_fname):
+    # Read the box lengths from the header of a LAMMPS data file
+    box = {}
+    with open(data_fname, 'rt') as lines:
+        for line in lines:
+            fields = line.split()
+            if len(fields) == 4 and fields[2][1:] == 'lo' and fields[3][1:] == 'hi':
+                box[fields[2][0]] = float(fields[1]) - float(fields[0])
+            if 'Masses' in line or 'Atoms' in line:
+                break
+    if len(box) < 3:
+        return None
+    return [box['x'], box['y'], box['z']]
+
+
+def read_atom_style(data_fname):
+    # Read the atom_style hint of the Atoms header of a LAMMPS data file; a
+    # header without hint is the full style of EMC data files
+    with open(data_fname, 'rt') as lines:
+        for line in lines:
+            if line.startswith('Atoms'):
+                fields = line.split('#', 1)
+                if len(fields) == 2 and fields[1].strip():
+                    return fields[1].split()[0]
+                return 'full'
+    return None
@@ -1,31 +1,487 @@
+import os
+import shutil
+import tempfile
+import numpy as np
 import nnmdkit
+from nnmdkit.util import Util
+from nnmdkit.core.Analysis import fit_Tg
+from nnmdkit.core.Database import parse_run_dir
+from nnmdkit.core.Job import OPENMPI_BINDING
 
 smiles = [
     '*CC*', '*CC(*)C', '*CC(*)CC', '*CC(*)CCC', '*CC(*)CCCC', '*CC(*)c1ccccc1'
 ]
 
-for s in smiles:
-    sys = nnmdkit.System(smiles=s, mw=10000, ntotal=3000, density=0.5)
-    data = sys.write_data(output_dir=s)
-
-    lmp = nnmdkit.Lammps(data, NN_POTENTIAL='potential_saved')
-    lmp.add_procedure('minimization', min_style='cg')
-    lmp.add_procedure('equilibration',
-                      Tfinal=600,
-                      Pfinal=1,
-                      Tmax=800,
-                      Pmax=49346.163)
-    lmp.add_procedure('Tg_measurement',
-                      Tinit=600,
-                      Tfinal=100,
-                      Tinterval=25,
-                      step=1000000)
-    lmp.write_input(output_dir=s)
-
-    job = nnmdkit.Job(jobname=s,
-                      project='GT-rramprasad3-CODA20',
-                      nodes=2,
-                      ppn=24,
-                      walltime='48:00:00',
-                      LAMMPS_EXEC='~/p-rramprasad3-0/NNLMP/lmp')
-    job.write_pbs(output_dir=s)
+
+def write_traj(fname, steps, L, natoms, rng, header='pp pp pp'):
+    with open(fname, 'w') as f:
+        for step in steps:
+            x = rng.random((natoms, 3))
+            f.write('ITEM: TIMESTEP\n{}\n'.format(step))
+            f.write('ITEM: NUMBER OF ATOMS\n{}\n'.format(natoms))
+            f.write('ITEM: BOX BOUNDS {}\n'.format(header))
+            for _ in range(3):
+                f.write('0.0 {}\n'.format(L))
+            f.write('ITEM: ATOMS id mol type q xs ys zs ix iy iz\n')
+            for i in rng.permutation(natoms):
+                f.write('{} {} 1 0 {} {} {} 0 1 0\n'.format(
+                    i + 1, i // 100 + 1, *x[i]))
+
+
+def test_analysis():
+    # Ideal gas of 20 chains in a 35 A box: g(r) ~ 1, and atoms dumped with
+    # an image flag of 1 in y are unwrapped by one box length
+    rng = np.random.default_rng(0)
+    L, natoms = 35.0, 2000
+    with tempfile.TemporaryDirectory() as tmp:
+        traj = os.path.join(tmp, 'production.lammpstrj')
+        write_traj(traj, [0, 10000, 20000], L, natoms, rng)
+
+        ana = nnmdkit.Analysis(traj, rdf_rmax=10.0, nprocs=2)
+        frame = next(ana.iter_frames())
+        assert list(frame['id']) == list(range(1, natoms + 1))
+        assert frame['coords'][:, 1].min() >= L
+
+        results = ana.run(output_dir=os.path.join(tmp, 'analysis'), every=2)
+        assert list(results['step']) == [0, 20000]
+        assert results['rg'].shape == (2, 2)
+        assert abs(results['rdf'][50:].mean() - 1) < 0.05
+        for fname in ['rg_vs_step', 'end_to_end_vs_step', 'rdf']:
+            assert os.path.isfile(os.path.join(tmp, 'analysis', fname))
+
+        # Small box with only two cells per direction: same g(r) as all pairs
+        write_traj(traj, [0], 21.0, 300, rng)
+        frame = next(ana.iter_frames())
+        box = frame['box']
+        dr = frame['coords'][:, None, :] - frame['coords'][None, :, :]
+        dr -= np.round(dr / box) * box
+        r = np.sqrt(np.sum(dr**2, axis=2))[np.triu_indices(300, 1)]
+        hist = 2 * np.histogram(r, bins=100, range=(0, 10.0))[0]
+        shell = 4.0 / 3.0 * np.pi * np.diff(np.linspace(0, 10.0, 101)**3)
+        expected = hist / (300 * 300 / np.prod(box) * shell)
+        g = ana.run(output_dir=os.path.join(tmp, 'analysis'))['rdf']
+        assert np.allclose(g, expected)
+
+        for L, header in [(15.0, 'pp pp pp'), (35.0, 'xy xz yz pp pp pp')]:
+            write_traj(traj, [0], L, 300, rng, header)
+            try:
+                ana.run(output_dir=os.path.join(tmp, 'analysis'))
+            except ValueError:
+                continue
+            raise AssertionError('box accepted: {} {}'.format(L, header))
+
+
+def test_ramp():
+    assert Util.ns_to_steps(1, 0.001, 'metal') == 1000000
+    assert Util.ns_to_steps(1, 1, 'real') == 1000000
+
+    with tempfile.TemporaryDirectory() as tmp:
+        lmp = nnmdkit.Lammps('system.data', NN_POTENTIAL='potential_saved')
+        lmp.add_procedure('Tg_measurement',
+                          protocol='ramp',
+                          Tinit=600,
+                          Tfinal=100,
+                          Tinterval=25,
+                          cooling_rate=100)
+        lmp.write_input(output_dir=tmp)
+        with open(os.path.join(tmp, 'lmp.in')) as f:
+            lines = f.read()
+        # 5 ns at 1 fs in 20 bins of 25 K
+        assert 'fix             fNPT all npt temp 600 100' in lines
+        assert 'run             5000000\n' in lines
+        assert 'ave/time 2500 100 250000 v_Temp v_Rho' in lines
+        assert lmp.total_steps() == 5000000
+
+    for kwargs in [{'Tinit': 100, 'Tfinal': 500}, {'cooling_rate': 0},
+                   {'Tinterval': -20}]:
+        try:
+            nnmdkit.Lammps('system.data', 'potential_saved').add_procedure(
+                'Tg_measurement', protocol='ramp', **kwargs)
+        except ValueError:
+            continue
+        raise AssertionError('invalid ramp accepted: {}'.format(kwargs))
+
+
+def test_fit_Tg():
+    temp = np.arange(100, 501, 20.0)
+    density = np.where(temp < 300, 1.0 - 2e-4 * (temp - 300),
+                       1.0 - 6e-4 * (temp - 300))
+    assert abs(fit_Tg(temp, density) - 300) < 1e-6
+
+
+def test_database():
+    with tempfile.TemporaryDirectory() as tmp:
+        campaign = os.path.join(tmp, 'campaign')
+        for name in ['done', 'new']:
+            os.makedirs(os.path.join(campaign, name))
+            open(os.path.join(campaign, name, 'lmp.in'), 'w').close()
+        with open(os.path.join(campaign, 'done', 'log.lammps'), 'w') as f:
+            f.write('Loop time of 12.5 on 48 procs for 50000 steps\n')
+            f.write('Equilibrated density: 0.91\n')
+            f.write('Loop time of 2.5 on 48 procs for 50000 steps\n')
+            f.write('Total wall time: 1:02:03\n')
+        with open(os.path.join(campaign, 'done', 'temp_vs_density'),
+                  'w') as f:
+            f.write('# TimeStep v_Temp v_Rho\n')
+            for n, T in enumerate(range(500, 99, -20)):
+                rho = 1.0 - (2e-4 if T < 300 else 6e-4) * (T - 300)
+                f.write('{} {} {}\n'.format(n, T, rho))
+
+        db = nnmdkit.Database(os.path.join(tmp, 'results.sqlite'))
+        assert db.collect(campaign) == 2
+        assert db.collect(campaign) == 0
+        rows = db.query('SELECT name, state, Tg, final_density, final_temp, '
+                        'nsteps, wall_time FROM results ORDER BY name')
+        assert rows[0][:2] == ('done', 'completed')
+        assert abs(rows[0][2] - 300) < 1e-6
+        assert rows[0][3:] == (0.91, 100.0, 100000, 3723.0)
+        assert rows[1][:2] == ('new', 'prepared')
+
+        # Only the changed directory is reprocessed; removed ones are dropped
+        open(os.path.join(campaign, 'new', 'job.pbs'), 'w').close()
+        os.remove(os.path.join(campaign, 'done', 'lmp.in'))
+        assert db.collect(campaign) == 1
+        assert db.query('SELECT name FROM results') == [('new', )]
+
+
+def test_hybrid_layout():
+    assert Util.hybrid_layout(2, 24) == (48, 1)
+    assert Util.hybrid_layout(2, 24, nthreads=4) == (12, 4)
+    assert Util.hybrid_layout(2, 24, 'auto', natoms=3000) == (6, 8)
+    assert Util.hybrid_layout(2, 24, 'auto', natoms=100000) == (48, 1)
+    try:
+        Util.hybrid_layout(2, 24, nthreads=5)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('ppn not divisible by nthreads accepted')
+
+    job = dict(jobname='PE',
+               project='GT-rramprasad3-CODA20',
+               nodes=2,
+               ppn=24,
+               walltime='48:00:00',
+               LAMMPS_EXEC='lmp',
+               nthreads='auto',
+               natoms=3000)
+    # Threads only with a pair style that has an /omp variant
+    try:
+        nnmdkit.Job(**job)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('threads accepted without an /omp pair style')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        nnmdkit.Job(**job, omp_pair_style=True).write_pbs(output_dir=tmp)
+        with open(os.path.join(tmp, 'job.pbs')) as f:
+            assert 'mpirun -np 6 lmp -sf omp -pk omp 8 -in lmp.in' in f.read()
+
+        job = nnmdkit.Job(**job, omp_pair_style=True, mpi_flags=OPENMPI_BINDING)
+        job.write_pbs(output_dir=tmp)
+        with open(os.path.join(tmp, 'job.pbs')) as f:
+            lines = f.read()
+        assert 'export OMP_NUM_THREADS=8\n' in lines
+        assert 'mpirun -np 6 --map-by ppr:3:node:PE=8 --bind-to core lmp -sf omp -pk omp 8 -in lmp.in' in lines
+
+        lmp = nnmdkit.Lammps('system.data', 'potential_saved',
+                             nranks=job.nranks)
+        lmp.write_input(output_dir=tmp)
+        with open(os.path.join(tmp, 'lmp.in')) as f:
+            lines = f.read()
+        # OpenMP is configured only on the command line
+        assert 'package' not in lines and 'suffix' not in lines
+        assert 'processors      2 1 3\n' in lines
+
+
+def test_load_balance():
+    assert sorted(Util.processor_grid(48)) == [3, 4, 4]
+    # An elongated box gets more ranks along its long side
+    assert Util.processor_grid(8, [160.0, 20.0, 20.0]) == [8, 1, 1]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(os.path.join(tmp, 'system.data'), 'w') as f:
+            f.write('LAMMPS data\n\n  3000  atoms\n\n')
+            f.write('  -10.0 150.0 xlo xhi\n  0.0 20.0 ylo yhi\n')
+            f.write('  0.0 20.0 zlo zhi\n\nMasses\n\n  1 12.011\n')
+        assert Util.read_box(os.path.join(tmp, 'system.data')) == [
+            160.0, 20.0, 20.0
+        ]
+
+        lmp = nnmdkit.Lammps('system.data', 'potential_saved', nranks=8)
+        lmp.write_input(output_dir=tmp)
+        with open(os.path.join(tmp, 'lmp.in')) as f:
+            lines = f.read()
+        assert 'processors      8 1 1\n' in lines
+        assert 'balance         1.1 shift xyz 10 1.1\n' in lines
+        assert 'fix             fBAL all balance 10000 1.1 shift xyz 10 1.1\n' in lines
+
+        lmp.add_procedure('load_balance',
+                          processors='* * 1',
+                          style='rcb',
+                          comm_cutoff=12.0,
+                          every=0)
+        lmp.write_input(output_dir=tmp)
+        with open(os.path.join(tmp, 'lmp.in')) as f:
+            lines = f.read()
+        assert 'processors      * * 1\ncomm_style      tiled\n' in lines
+        assert 'comm_modify     cutoff 12.0\nbalance         1.1 rcb\n' in lines
+        assert 'fBAL' not in lines
+
+        # A single rank gets no balancing unless asked for
+        nnmdkit.Lammps('system.data', 'potential_saved').write_input(tmp)
+        with open(os.path.join(tmp, 'lmp.in')) as f:
+            assert 'balance' not in f.read()
+
+
+def test_lean_profile():
+    with tempfile.TemporaryDirectory() as tmp:
+        for atom_style, columns in [
+            ('full', 'id mol type q xs ys zs ix iy iz'),
+            ('molecular', 'id mol type xs ys zs ix iy iz'),
+            ('atomic', 'id type xs ys zs ix iy iz'),
+        ]:
+            lmp = nnmdkit.Lammps('system.data',
+                                 'potential_saved',
+                                 atom_style=atom_style)
+            lmp.add_procedure('equilibration')
+            lmp.write_input(output_dir=tmp)
+            with open(os.path.join(tmp, 'lmp.in')) as f:
+                lines = f.read()
+            with open(os.path.join(tmp, 'system.in.settings')) as f:
+                settings = f.read()
+            assert 'atom_style      {}\n'.format(atom_style) in lines
+            assert 'equil.lammpstrj {}\n'.format(columns) in lines
+            if atom_style == 'full':
+                assert 'ebond evdwl ecoul elong' in settings
+                assert 'thermo          100\n' in settings
+            else:
+                assert 'custom step temp density vol press pe\n' in settings
+                assert 'thermo          1000\n' in settings
+
+        lmp = nnmdkit.Lammps('system.data',
+                             'potential_saved',
+                             atom_style='atomic',
+                             thermo=500)
+        lmp.write_input(output_dir=tmp)
+        with open(os.path.join(tmp, 'system.in.settings')) as f:
+            assert 'thermo          500\n' in f.read()
+
+        # atom_style defaults to the hint of the data file and must match it
+        with open(os.path.join(tmp, 'system.data'), 'w') as f:
+            f.write('LAMMPS data\n\n  3000  atoms\n\nAtoms # atomic\n\n')
+        nnmdkit.Lammps('system.data', 'potential_saved').write_input(tmp)
+        with open(os.path.join(tmp, 'lmp.in')) as f:
+            assert 'atom_style      atomic\n' in f.read()
+        for atom_style in ['full', 'charge']:
+            try:
+                nnmdkit.Lammps('system.data', 'potential_saved',
+                               atom_style=atom_style).write_input(tmp)
+            except ValueError:
+                continue
+            raise AssertionError('atom_style {} accepted'.format(atom_style))
+
+
+def test_work_queue():
+    job = dict(jobname='PE',
+               project='GT-rramprasad3-CODA20',
+               nodes=1,
+               ppn=24,
+               walltime='48:00:00',
+               LAMMPS_EXEC='lmp')
+    system = dict(smiles='*CC*', mw=10000, ntotal=3000, density=0.5)
+    with tempfile.TemporaryDirectory() as tmp:
+        q = nnmdkit.WorkQueue(os.path.join(tmp, 'queue'),
+                              lease=60,
+                              max_retries=2)
+        ids = [
+            q.submit(os.path.join(tmp, str(p)), system, job, priority=p)
+            for p in [5, -1, 0, -10]
+        ]
+        try:
+            q.submit(tmp, system, job, priority=10**9)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('out-of-range priority accepted')
+
+        # Lower priorities first, negative ones included
+        claims = [q.claim() for _ in range(4)]
+        assert [task['id'] for _, task in claims] == [ids[3], ids[1], ids[2], ids[0]]
+        assert q.claim() is None
+        assert q.status()['running'] == 4
+
+        # Worker A loses its lease, worker B claims the task again: A can
+        # neither complete nor keep B's claim alive
+        pA, tA = claims[0]
+        os.utime(pA, (0, 0))
+        assert q.recover() == 1
+        pB, tB = q.claim()
+        assert tB['id'] == tA['id'] and pB != pA and tB['attempts'] == 1
+        assert not q.complete(pA, tA)
+        assert q.complete(pB, tB)
+
+        # Failures are retried until max_retries, then moved to failed
+        p, task = claims[1]
+        assert q.fail(p, task, 'EMC failed')
+        p, task = q.claim()
+        assert q.fail(p, task, 'EMC failed')
+        assert q.status() == {
+            'pending': 0,
+            'running': 2,
+            'done': 1,
+            'failed': 1
+        }
+
+    # Full write_data -> write_input -> write_pbs pipeline with EMC mocked:
+    # the first attempt fails next to a data file left by an earlier one
+    calls = []
+
+    def write_data(self, output_dir, output_prefix='system', **kwargs):
+        calls.append(output_dir)
+        data = '{}.data'.format(output_prefix)
+        if len(calls) > 1:
+            with open(os.path.join(output_dir, data), 'w') as f:
+                f.write('LAMMPS data\n\n  3000  atoms\n\nAtoms # molecular\n')
+        return data
+
+    original = nnmdkit.System.write_data
+    nnmdkit.System.write_data = write_data
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            q = nnmdkit.WorkQueue(os.path.join(tmp, 'queue'), max_retries=2)
+            run_dir = os.path.join(tmp, 'PE')
+            q.submit(run_dir, system, job, lammps={'NN_POTENTIAL': 'pot'})
+            os.makedirs(run_dir)
+            open(os.path.join(run_dir, 'system.data'), 'w').close()
+            assert q.run_worker(poll=0) == 2
+            assert len(calls) == 2
+            assert q.status()['done'] == 1
+            with open(os.path.join(run_dir, 'lmp.in')) as f:
+                assert 'atom_style      molecular\n' in f.read()
+            assert os.path.isfile(os.path.join(run_dir, 'job.pbs'))
+    finally:
+        nnmdkit.System.write_data = original
+
+
+def test_screening():
+    entries = []
+    for s in ['*CC*', '*CC(*)c1ccccc1']:
+        lmp = nnmdkit.Lammps('system.data', 'potential_saved')
+        lmp.add_procedure('equilibration')
+        lmp.add_procedure('Tg_measurement')
+        entries.append((nnmdkit.System(s, 10000, 3000, 0.5), lmp))
+    # 21 default equilibration steps plus 21 holds of 1,000,000 steps
+    assert entries[0][1].total_steps() == 1560000 + 21 * 1000000
+
+    with tempfile.TemporaryDirectory() as tmp:
+        budget = entries[1][0].predict_natoms() * 22560000
+        ranking = nnmdkit.Screening(Tg_target=350,
+                                    budget=budget).rank(entries,
+                                                        output_dir=tmp)
+        assert [i['smiles'] for i in ranking] == ['*CC(*)c1ccccc1', '*CC*']
+        assert [i['selected'] for i in ranking] == [True, False]
+        with open(os.path.join(tmp, 'ranking.csv')) as f:
+            assert len(f.readlines()) == 3
+
+
+def test_library():
+    system = nnmdkit.System('*CC*', 10000, 3000, 0.5)
+    with tempfile.TemporaryDirectory() as tmp:
+        potential = os.path.join(tmp, 'potential_saved')
+        with open(potential, 'w') as f:
+            f.write('potential v1\n')
+        lib = nnmdkit.Library(os.path.join(tmp, 'library'))
+
+        def lammps(potential=potential):
+            lmp = nnmdkit.Lammps('system.data', potential)
+            lmp.add_procedure('minimization')
+            lmp.add_procedure('equilibration', Tfinal=600)
+            lmp.add_procedure('Tg_measurement')
+            lmp.use_library(lib, system)
+            return lmp
+
+        key, params = lib.key(system, lammps())
+        assert lib.key(system, lammps())[0] == key
+        eq_steps = lammps().eq_kwargs['eq_totaltime']
+        full_steps = lammps().total_steps()
+
+        # Miss: full input that registers its equilibrated state
+        run_dir = os.path.join(tmp, 'miss')
+        lammps().write_input(output_dir=run_dir)
+        with open(os.path.join(run_dir, 'lmp.in')) as f:
+            lines = f.read()
+        assert 'read_data' in lines and '### Equilibration' in lines
+        assert 'write_restart   {}.tmp'.format(lib.restart_path(key)) in lines
+
+        # Hit: production-only input, cheaper for Screening, and seen as
+        # equilibrated by Database once it has started
+        restart = os.path.join(tmp, 'equilibrated.restart')
+        open(restart, 'w').close()
+        lib.register(key, restart, params)
+        assert lammps().total_steps() == full_steps - eq_steps
+        run_dir = os.path.join(tmp, 'hit')
+        lammps().write_input(output_dir=run_dir)
+        with open(os.path.join(run_dir, 'lmp.in')) as f:
+            lines = f.read()
+        assert 'read_restart    {}\n'.format(lib.restart_path(key)) in lines
+        assert 'read_data' not in lines and 'minimize' not in lines
+        assert '### Equilibration' not in lines
+        assert parse_run_dir(run_dir)['state'] == 'prepared'
+        open(os.path.join(run_dir, 'log.lammps'), 'w').close()
+        assert parse_run_dir(run_dir)['state'] == 'equilibrated'
+
+        # A relative potential is found from the run directory of the entry
+        shutil.copyfile(potential, os.path.join(run_dir, 'potential_saved'))
+        estimate = nnmdkit.Screening().estimate(system,
+                                                lammps('potential_saved'),
+                                                run_dir)
+        assert estimate['nsteps'] == full_steps - eq_steps
+        try:
+            lammps('potential_saved').total_steps()
+        except FileNotFoundError:
+            pass
+        else:
+            raise AssertionError('unreachable potential costed as a miss')
+
+        # A retrained potential under the same file name gets a new key
+        with open(potential, 'w') as f:
+            f.write('potential v2, retrained\n')
+        assert lib.key(system, lammps())[0] != key
+        assert lammps().total_steps() == full_steps
+
+
+def run_campaign():
+    for s in smiles:
+        sys = nnmdkit.System(smiles=s, mw=10000, ntotal=3000, density=0.5)
+        data = sys.write_data(output_dir=s)
+
+        lmp = nnmdkit.Lammps(data, NN_POTENTIAL='potential_saved')
+        lmp.add_procedure('minimization', min_style='cg')
+        lmp.add_procedure('equilibration',
+                          Tfinal=600,
+                          Pfinal=1,
+                          Tmax=800,
+                          Pmax=49346.163)
+        lmp.add_procedure('Tg_measurement',
+                          Tinit=600,
+                          Tfinal=100,
+                          Tinterval=25,
+                          step=1000000)
+        lmp.write_input(output_dir=s)
+
+        job = nnmdkit.Job(jobname=s,
+                          project='GT-rramprasad3-CODA20',
+                          nodes=2,
+                          ppn=24,
+                          walltime='48:00:00',
+                          LAMMPS_EXEC='~/p-rramprasad3-0/NNLMP/lmp')
+        job.write_pbs(output_dir=s)
+
+
+if __name__ == '__main__':
+    # Checks that need neither EMC nor LAMMPS, then the full EMC smoke run
+    for name, check in list(globals().items()):
+        if name.startswith('test_'):
+            check()
+    run_campaign()